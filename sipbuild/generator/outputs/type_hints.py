@@ -3,10 +3,9 @@
 # Copyright (c) 2024 Phil Thompson <phil@riverbankcomputing.com>
 
 
-from dataclasses import dataclass, field
 from enum import auto, Enum
-from typing import List, Optional, Union
-from weakref import WeakKeyDictionary
+import re
+from typing import Optional, Tuple, Union
 
 from ...exceptions import UserException
 
@@ -15,13 +14,26 @@ from ..specification import MappedType, WrappedClass, WrappedEnum
 
 
 # The types defined in the typing module.
-_TYPING_MODULE = (
+_TYPING_MODULE = frozenset((
     'Any', 'NoReturn', 'Tuple', 'Union', 'Optional', 'Callable', 'Type',
     'Literal', 'ClassVar', 'Final', 'Annotated', 'AnyStr', 'Protocol',
     'NamedTuple', 'Dict', 'List', 'Set', 'FrozenSet', 'IO', 'TextIO',
     'BinaryIO', 'Pattern', 'Match', 'Text', 'Iterable', 'Iterator',
     'Generator', 'Mapping', 'Sequence',
-)
+))
+
+# The delimiters of the parts of a type hint.
+_DELIMITERS = re.compile(r'[\[\],]')
+
+# The syntax of each type hint that has been parsed.  This doesn't depend on
+# the specification so it is shared by all of them.
+_syntax_cache = {}
+
+# The marker for a value missing from a cache where None is a valid value.
+_MISSING = object()
+
+# The fully qualified names of the types defined in the typing module.
+_PEP484_TYPING_NAMES = {name: 'typing.' + name for name in _TYPING_MODULE}
 
 
 class NodeType(Enum):
@@ -41,60 +53,92 @@ class ParseState(Enum):
     PARSED = auto()
 
 
-@dataclass
 class ManagedTypeHint:
     """ Encapsulate a managed type hint. """
 
+    # These are created for every type hint so avoid a per-instance dict.
+    __slots__ = ('type_hint', 'as_docstring', 'as_rest_ref', 'parse_state',
+            'root')
+
     # The type hint being managed.
     type_hint: str
 
     # The rendered docstring.
-    as_docstring: Optional[str] = None
+    as_docstring: Optional[str]
 
     # The rendered reST reference.
-    as_rest_ref: Optional[str] = None
+    as_rest_ref: Optional[str]
 
     # The parse state.
-    parse_state: ParseState = ParseState.REQUIRED
+    parse_state: ParseState
 
     # The root node.
-    root: Optional['TypeHintNode'] = None
+    root: Optional['TypeHintNode']
+
+    def __init__(self, type_hint):
+        """ Initialise the managed type hint. """
+
+        self.type_hint = type_hint
+        self.as_docstring = None
+        self.as_rest_ref = None
+        self.parse_state = ParseState.REQUIRED
+        self.root = None
 
 
-@dataclass
 class TypeHintNode:
     """ Encapsulate a node of a parsed type hint. """
 
+    # These are created for every part of every type hint so avoid a
+    # per-instance dict.
+    __slots__ = ('type', 'children', 'definition')
+
     # The type.
     type: NodeType
 
-    # The list of child nodes.
-    children: Optional[List['TypeHintNode']] = None
+    # The child nodes.  A tuple is used as it is smaller than a list and
+    # nodes must not be changed once parsed.
+    children: Optional[Tuple['TypeHintNode', ...]]
 
     # The type-dependent definition.
-    definition: Optional[Union[str, MappedType, WrappedClass, WrappedEnum]] = None
+    definition: Optional[Union[str, MappedType, WrappedClass, WrappedEnum]]
+
+    def __init__(self, type, children=None, definition=None):
+        """ Initialise the node. """
+
+        self.type = type
+        self.children = children
+        self.definition = definition
 
 
 class TypeHintManager:
     """ A manager for type hints on behalf of a Specification object. """
 
-    # The map of specification objects and the corresponding manager object.
-    _spec_manager_map = WeakKeyDictionary()
+    # The map of specification object ids and the corresponding manager
+    # object.  A manager keeps a reference to its specification so an id
+    # cannot be reused while it is in the map.
+    _spec_manager_map = {}
 
     def __new__(cls, spec):
         """ Return the existing manager for a specification or create a new one
         if necessary.
         """
 
-        try:
-            manager = cls._spec_manager_map[spec]
-        except KeyError:
+        manager = cls._spec_manager_map.get(id(spec))
+        if manager is None:
             manager = object.__new__(cls)
 
             manager._spec = spec
             manager._managed_type_hints = {}
+            manager._render_cache = {}
+            manager._enum_index = None
+            manager._class_index = None
+            manager._mapped_type_index = None
+            manager._scoped_name_cache = {}
+            manager._leaf_node_cache = {}
+            manager._definition_type_hint_cache = {}
+            manager._definition_name_cache = {}
 
-            cls._spec_manager_map[spec] = manager
+            cls._spec_manager_map[id(spec)] = manager
 
         return manager
 
@@ -137,83 +181,110 @@ class TypeHintManager:
         type hint.
         """
 
-        try:
-            hint_in, hint_out = self._managed_type_hints[type_hint]
-        except KeyError:
-            hint_in = ManagedTypeHint(type_hint)
-            hint_out = ManagedTypeHint(type_hint)
-            self._managed_type_hints[type_hint] = (hint_in, hint_out)
+        managed_type_hints = self._managed_type_hints.get(type_hint)
+        if managed_type_hints is None:
+            managed_type_hints = (ManagedTypeHint(type_hint),
+                    ManagedTypeHint(type_hint))
+            self._managed_type_hints[type_hint] = managed_type_hints
 
-        return hint_out if out else hint_in
+        return managed_type_hints[1] if out else managed_type_hints[0]
 
-    def _parse(self, managed_type_hint, out):
-        """ Ensure a type hint has been parsed. """
+    def _get_definition_name(self, definition, rest_ref):
+        """ Return the reST reference or the scoped Python name of a class or
+        enum.  Unlike a type hint, neither depends on what has been defined so
+        each is only formatted once.
+        """
 
-        if managed_type_hint.parse_state is ParseState.REQUIRED:
-            managed_type_hint.root = self._parse_node(out,
-                    managed_type_hint.type_hint)
-            managed_type_hint.parse_state = ParseState.PARSED
+        key = (id(definition), rest_ref)
 
-    def _parse_node(self, out, text, start=0, end=None):
-        """ Return a single node of a parsed type hint. """
+        name = self._definition_name_cache.get(key)
+        if name is None:
+            from .formatters import (fmt_class_as_rest_ref,
+                    fmt_enum_as_rest_ref, fmt_scoped_py_name)
 
-        if end is None:
-            end = len(text)
-            top_level = True
-        else:
-            top_level = False
+            if not rest_ref:
+                name = fmt_scoped_py_name(definition.scope,
+                        definition.py_name.name)
+            elif isinstance(definition, WrappedClass):
+                name = fmt_class_as_rest_ref(definition)
+            else:
+                name = fmt_enum_as_rest_ref(definition)
 
-        # Find the name and any opening and closing brackets.
-        start = self._strip_leading(text, start, end)
-        name_start = start
+            self._definition_name_cache[key] = name
 
-        end = self._strip_trailing(text, start, end)
-        name_end = end
+        return name
 
-        children = None
+    def _get_definition_type_hint(self, definition, out):
+        """ Return the managed type hint, if any, of a class or mapped type. """
 
-        i = text[start:end].find('[')
-        if i >= 0:
-            i += start
+        key = (id(definition), out)
 
-            children = []
+        managed_type_hint = self._definition_type_hint_cache.get(key,
+                _MISSING)
+        if managed_type_hint is not _MISSING:
+            return managed_type_hint
 
-            # The last character must be a closing bracket.
-            if text[end - 1] != ']':
-                raise UserException(
-                        f"type hint '{text}': ']' expected at position {end}")
+        managed_type_hint = None
 
-            # Find the end of any name.
-            name_end = self._strip_trailing(text, name_start, i)
+        type_hints = definition.type_hints
+        if type_hints is not None:
+            type_hint = type_hints.hint_out if out else type_hints.hint_in
+            if type_hint is not None:
+                managed_type_hint = self._get_managed_type_hint(type_hint,
+                        out)
+
+        self._definition_type_hint_cache[key] = managed_type_hint
+
+        return managed_type_hint
+
+    def _parse(self, managed_type_hint, out):
+        """ Ensure a type hint has been parsed. """
+
+        if managed_type_hint.parse_state is ParseState.REQUIRED:
+            managed_type_hint.root = self._parse_node(out,
+                    _get_syntax(managed_type_hint.type_hint))
+            managed_type_hint.parse_state = ParseState.PARSED
+
+    def _parse_node(self, out, syntax):
+        """ Return the root node of a parsed type hint given its syntax. """
 
-            while True:
-                # Skip the opening bracket or comma.
-                i += 1
+        # Get the parts in the order they must be resolved (ie. each part
+        # after its own parts) without using recursion.
+        ordered = []
+        stack = [syntax]
 
-                # Find the next comma, if any.
-                depth = 0
+        while stack:
+            part = stack.pop()
+            ordered.append(part)
 
-                for part_i in range(i, end):
-                    if text[part_i] == '[':
-                        depth += 1
+            if part[1] is not None:
+                stack.extend(reversed(part[1]))
 
-                    elif text[part_i] == ']' and depth != 0:
-                        depth -= 1
+        # Resolve each part.  The nodes of the parts of each part are the last
+        # ones to have been resolved (in reverse order).
+        nodes = []
 
-                    elif text[part_i] in ',]' and depth == 0:
-                        # Recursively parse this part.
-                        children.append(self._parse_node(out, text, i, part_i))
+        for name, children in reversed(ordered):
+            if children is not None:
+                nr_children = len(children)
 
-                        i = part_i
-                        break
+                if nr_children == 0:
+                    children = ()
                 else:
-                    break
+                    children = tuple(reversed(nodes[-nr_children:]))
+                    del nodes[-nr_children:]
 
-        # See if we have a name.
-        if name_start != name_end:
-            # Get the name. */
-            name = text[name_start:name_end]
+            nodes.append(self._resolve_node(out, name, children))
 
+        return nodes[0]
+
+    def _resolve_node(self, out, name, children):
+        """ Return a single node of a parsed type hint given its name and the
+        nodes of any children.
+        """
+
+        # See if we have a name.
+        if name:
             # See if it is an object in the typing module.
             if name in _TYPING_MODULE:
                 if name == 'Union':
@@ -222,17 +293,18 @@ class TypeHintManager:
                     if len(children) == 0:
                         return None
 
-                    # Flatten any unions.
-                    flattened = []
+                    # Flatten any unions.  Nested unions are unusual so check
+                    # first rather than always creating a new list.
+                    if any(child.type is NodeType.TYPING and child.definition == 'Union' for child in children):
+                        flattened = []
 
-                    for child in children:
-                        if child.type is NodeType.TYPING and child.definition == 'Union':
-                            for grandchild in child.children:
-                                flattened.append(grandchild)
-                        else:
-                            flattened.append(child)
+                        for child in children:
+                            if child.type is NodeType.TYPING and child.definition == 'Union':
+                                flattened.extend(child.children)
+                            else:
+                                flattened.append(child)
 
-                    children = flattened
+                        children = tuple(flattened)
 
                 node = TypeHintNode(NodeType.TYPING, children=children,
                         definition=name)
@@ -240,11 +312,6 @@ class TypeHintManager:
                 # Search for the type.
                 node = self._lookup_type(name, out, children)
         else:
-            # At the top level we must have brackets and they must not be empty.
-            if top_level and (children is None or len(children) == 0):
-                raise UserException(
-                        f"type hint '{text}': must have non-empty brackets")
-
             # Return the representation of brackets.
             node = TypeHintNode(NodeType.TYPING, children=children)
 
@@ -270,20 +337,52 @@ class TypeHintManager:
             if context is not None:
                 context_stack.pop()
         else:
-            s = self._maybe_any_object(managed_type_hint.type_hint, pep484,
-                    as_xml)
+            s = managed_type_hint.type_hint
+
+            # Take into account that it may be any sort of object.  Don't worry
+            # if the voidptr name is qualified in any way.
+            if s == 'Any':
+                s = 'typing.Any' if pep484 else 'object'
+            elif s.endswith('voidptr'):
+                s = format_voidptr(self._spec, as_xml)
 
         return s
 
     def _render_node(self, node, out, pep484, rest_ref, defined, as_xml,
             context_stack):
-        """ Render a single node. """
+        """ Render a single node, re-using any previous rendering. """
+
+        # Handle the most common case of a bare name from the typing module.
+        if node.type is NodeType.TYPING and node.children is None and node.definition is not None:
+            return _PEP484_TYPING_NAMES[node.definition] if pep484 else node.definition
+
+        # A .pyi type hint depends on what has been defined so far, which
+        # changes after every class, so it is not worth caching.
+        if defined is not None:
+            return self._render_node_uncached(node, out, pep484, rest_ref,
+                    defined, as_xml, context_stack)
+
+        # Nodes are not changed once parsed so they can be identified by their
+        # id.
+        key = (id(node), out, pep484, rest_ref, as_xml, tuple(context_stack))
+
+        s = self._render_cache.get(key)
+        if s is None:
+            s = self._render_node_uncached(node, out, pep484, rest_ref,
+                    defined, as_xml, context_stack)
+            self._render_cache[key] = s
+
+        return s
+
+    def _render_node_uncached(self, node, out, pep484, rest_ref, defined,
+            as_xml, context_stack):
+        """ Render a single node without using any previous rendering. """
 
         if node.type is NodeType.TYPING:
             if node.definition is None:
                 s = ''
             elif pep484:
-                s = 'typing.' + node.definition
+                s = _PEP484_TYPING_NAMES[node.definition]
             else:
                 s = node.definition
 
@@ -297,121 +396,146 @@ class TypeHintManager:
             klass = node.definition
 
             # Get any managed type hint.
-            type_hints = klass.type_hints
-            if type_hints is not None:
-                type_hint = type_hints.hint_out if out else type_hints.hint_in
-                if type_hint is not None:
-                    managed_type_hint = self._get_managed_type_hint(type_hint,
-                            out)
-
-                    # If the type hint isn't in the current context then render
-                    # it.
-                    if klass not in context_stack:
-                        context_stack.append(klass)
-                        s = self._render(managed_type_hint, out,
-                                pep484=pep484, rest_ref=rest_ref,
-                                defined=defined, as_xml=as_xml,
-                                context_stack=context_stack)
-                        context_stack.pop()
-
-                        return s
+            managed_type_hint = self._get_definition_type_hint(klass, out)
+            if managed_type_hint is not None:
+                # If the type hint isn't in the current context then render it.
+                if klass not in context_stack:
+                    context_stack.append(klass)
+                    s = self._render(managed_type_hint, out, pep484=pep484,
+                            rest_ref=rest_ref, defined=defined, as_xml=as_xml,
+                            context_stack=context_stack)
+                    context_stack.pop()
 
-            from .formatters import (fmt_class_as_rest_ref,
-                    fmt_class_as_type_hint, fmt_scoped_py_name)
+                    return s
 
-            if rest_ref:
-                return fmt_class_as_rest_ref(klass)
+            if rest_ref or not pep484:
+                return self._get_definition_name(klass, rest_ref)
 
-            if pep484:
-                return fmt_class_as_type_hint(self._spec, klass, defined)
+            from .formatters import fmt_class_as_type_hint
 
-            return fmt_scoped_py_name(klass.scope, klass.py_name.name)
+            return fmt_class_as_type_hint(self._spec, klass, defined)
 
         if node.type is NodeType.MAPPED_TYPE:
             mapped_type = node.definition
 
             # Get any managed type hint.
-            type_hints = mapped_type.type_hints
-            if type_hints is not None:
-                type_hint = type_hints.hint_out if out else type_hints.hint_in
-                if type_hint is not None:
-                    managed_type_hint = self._get_managed_type_hint(type_hint,
-                            out)
-
-                    return self._render(managed_type_hint, out, pep484=pep484,
-                            rest_ref=rest_ref, defined=defined, as_xml=as_xml,
-                            context_stack=context_stack)
+            managed_type_hint = self._get_definition_type_hint(mapped_type,
+                    out)
+            if managed_type_hint is not None:
+                return self._render(managed_type_hint, out, pep484=pep484,
+                        rest_ref=rest_ref, defined=defined, as_xml=as_xml,
+                        context_stack=context_stack)
 
             # This will only happen if the mapped type doesn't have type hints.
             return mapped_type.cpp_name.name
 
         if node.type is NodeType.ENUM:
-            from .formatters import (fmt_enum_as_rest_ref,
-                    fmt_enum_as_type_hint, fmt_scoped_py_name)
-
             enum = node.definition
 
-            if rest_ref:
-                return fmt_enum_as_rest_ref(enum)
+            if rest_ref or not pep484:
+                return self._get_definition_name(enum, rest_ref)
 
-            if pep484:
-                return fmt_enum_as_type_hint(self._spec, enum, defined)
+            from .formatters import fmt_enum_as_type_hint
 
-            return fmt_scoped_py_name(enum.scope, enum.py_name.name)
+            return fmt_enum_as_type_hint(self._spec, enum, defined)
 
         # We only render children for docstrings.
         if node.children is not None and defined is None:
             return node.definition + self._render_children(node, out, pep484,
                     rest_ref, defined, as_xml, context_stack)
 
-        return self._maybe_any_object(node.definition, pep484, as_xml)
+        # Take into account that it may be any sort of object.  Don't worry if
+        # the voidptr name is qualified in any way.
+        if node.definition == 'Any':
+            return 'typing.Any' if pep484 else 'object'
+
+        if node.definition.endswith('voidptr'):
+            return format_voidptr(self._spec, as_xml)
+
+        return node.definition
 
     def _render_children(self, node, out, pep484, rest_ref, defined, as_xml,
             context_stack):
         """ Render the children of a node. """
 
-        children = []
+        children = node.children
 
-        for child in node.children:
-            # For Callable the first argument is in and the rest (ie. the
-            # second) is out.
-            if node.definition == 'Callable':
-                fixed_out = child is not node.children[0]
-            else:
-                fixed_out = out
+        if not children:
+            return '[]'
+
+        # For Callable the first argument is in and the rest (ie. the second)
+        # is out.  Note that the first child must be identified by its position
+        # as a child node may be shared with other parsed type hints.
+        if node.definition == 'Callable':
+            first_out = False
+            rest_out = True
+        else:
+            first_out = rest_out = out
+
+        s = self._render_node(children[0], first_out, pep484, rest_ref,
+                defined, as_xml, context_stack)
 
-            children.append(
-                    self._render_node(child, fixed_out, pep484, rest_ref,
-                            defined, as_xml, context_stack))
+        # Avoid a join if there is only one child.
+        if len(children) == 1:
+            return '[' + s + ']'
 
-        return '[' + ', '.join(children) + ']'
+        rendered = [self._render_node(child, rest_out, pep484, rest_ref,
+                defined, as_xml, context_stack) for child in children[1:]]
+
+        return '[' + s + ', ' + ', '.join(rendered) + ']'
 
     def _lookup_enum(self, name, scopes):
         """ Lookup an enum using its C/C++ name. """
 
-        for enum in self._spec.enums:
-            if enum.fq_cpp_name is not None and enum.fq_cpp_name.base_name == name and enum.scope in scopes:
-                return enum
+        # Build the index on first use.  Each entry also records the position
+        # of the enum so that the first matching enum is always found.
+        if self._enum_index is None:
+            self._enum_index = {}
+
+            for enum_i, enum in enumerate(self._spec.enums):
+                if enum.fq_cpp_name is not None:
+                    self._enum_index.setdefault(
+                            (id(enum.scope), enum.fq_cpp_name.base_name),
+                            (enum_i, enum))
+
+        found = None
+
+        for scope in scopes:
+            entry = self._enum_index.get((id(scope), name))
+            if entry is not None and (found is None or entry[0] < found[0]):
+                found = entry
 
-        return None
+        return None if found is None else found[1]
 
     def _lookup_class(self, name, scope):
         """ Lookup a class/struct/union using its C/C++ name. """
 
-        for klass in self._spec.classes:
-            if klass.scope is scope and not klass.external and klass.iface_file.fq_cpp_name.base_name == name:
-                return klass
+        # Build the index on first use.
+        if self._class_index is None:
+            self._class_index = {}
 
-        return None
+            for klass in self._spec.classes:
+                if not klass.external:
+                    self._class_index.setdefault(
+                            (id(klass.scope),
+                                    klass.iface_file.fq_cpp_name.base_name),
+                            klass)
+
+        return self._class_index.get((id(scope), name))
 
     def _lookup_mapped_type(self, name):
         """ Lookup a mapped type using its C/C++ name. """
 
-        for mapped_type in self._spec.mapped_types:
-            if mapped_type.cpp_name is not None and mapped_type.cpp_name.name == name:
-                return mapped_type
+        # Build the index on first use.
+        if self._mapped_type_index is None:
+            self._mapped_type_index = {}
+
+            for mapped_type in self._spec.mapped_types:
+                if mapped_type.cpp_name is not None:
+                    self._mapped_type_index.setdefault(
+                            mapped_type.cpp_name.name, mapped_type)
 
-        return None
+        return self._mapped_type_index.get(name)
 
     def _lookup_type(self, name, out, children):
         """ Look up a qualified Python type and return the corresponding node.
@@ -421,8 +545,12 @@ class TypeHintManager:
         scope_klass = None
         scope_mapped_type = None
 
-        # We allow both Python and C++ scope separators.
-        scoped_name = ScopedName.parse(name.replace('.', '::'))
+        # We allow both Python and C++ scope separators.  The same names tend
+        # to be used many times so the individual parts are cached.
+        scoped_name = self._scoped_name_cache.get(name)
+        if scoped_name is None:
+            scoped_name = tuple(ScopedName.parse(name.replace('.', '::')))
+            self._scoped_name_cache[name] = scoped_name
 
         for part_i, part in enumerate(scoped_name):
             is_last_part = ((part_i + 1) == len(scoped_name))
@@ -431,7 +559,7 @@ class TypeHintManager:
             enum = self._lookup_enum(part, (scope_klass, scope_mapped_type))
             if enum is not None:
                 if is_last_part:
-                    return TypeHintNode(NodeType.ENUM, definition=enum)
+                    return self._leaf_node(NodeType.ENUM, enum)
 
                 # There is some left so the whole lookup has failed.
                 break
@@ -449,8 +577,8 @@ class TypeHintManager:
                     # If we have used the whole name then the lookup has
                     # succeeded.
                     if is_last_part:
-                        return TypeHintNode(NodeType.MAPPED_TYPE,
-                                definition=mapped_type)
+                        return self._leaf_node(NodeType.MAPPED_TYPE,
+                                mapped_type)
 
                     # Otherwise this is the scope for the next part.
                     scope_mapped_type = mapped_type
@@ -463,7 +591,7 @@ class TypeHintManager:
 
                 # If we have used the whole name then the lookup has succeeded.
                 if is_last_part:
-                    return TypeHintNode(NodeType.CLASS, definition=klass)
+                    return self._leaf_node(NodeType.CLASS, klass)
 
                 # Otherwise this is the scope for the next part.
                 scope_klass = klass
@@ -472,48 +600,28 @@ class TypeHintManager:
             if is_last_part:
                 break
 
-        # Nothing was found.
-        return TypeHintNode(NodeType.OTHER, definition=name, children=children)
-
-    def _maybe_any_object(self, hint, pep484, as_xml):
-        """ Return a hint taking into account that it may be any sort of
-        object.
-        """
-
-        if hint == 'Any':
-            return self._any_object(pep484)
-
-        # Don't worry if the voidptr name is qualified in any way.
-        if hint.endswith('voidptr'):
-            return format_voidptr(self._spec, as_xml)
+        # Nothing was found.  Only a node without children can be shared.
+        if children is not None:
+            return TypeHintNode(NodeType.OTHER, definition=name,
+                    children=children)
 
-        return hint
+        return self._leaf_node(NodeType.OTHER, name)
 
-    @staticmethod
-    def _any_object(pep484):
-        """ Return a hint taking into account that it may be any sort of
-        object.
+    def _leaf_node(self, node_type, definition):
+        """ Return the unique (for the specification) node without children
+        for a type and definition.
         """
 
-        return 'typing.Any' if pep484 else 'object'
-
-    @staticmethod
-    def _strip_leading(text, start, end):
-        """ Return the index of the first non-space of a string. """
-    
-        while start < end and text[start] == ' ':
-            start += 1
+        # Names are compared by value and everything else by identity.
+        key = (node_type,
+                definition if node_type is NodeType.OTHER else id(definition))
 
-        return start
+        node = self._leaf_node_cache.get(key)
+        if node is None:
+            node = TypeHintNode(node_type, definition=definition)
+            self._leaf_node_cache[key] = node
 
-    @staticmethod
-    def _strip_trailing(text, start, end):
-        """ Return the index after the last non-space of a string. """
-
-        while end > start and text[end - 1] == ' ':
-            end -= 1
-
-        return end
+        return node
 
 
 def format_voidptr(spec, as_xml):
@@ -527,3 +635,115 @@ def format_voidptr(spec, as_xml):
         return f':py:class:`~{voidptr}`'
 
     return voidptr
+
+
+def _get_syntax(text):
+    """ Return the syntax of a type hint as a (name, children) tuple where
+    children is either None or a tuple of the syntax of each part.
+    """
+
+    syntax = _syntax_cache.get(text)
+    if syntax is None:
+        end = len(text.rstrip(' '))
+        start = min(len(text) - len(text.lstrip(' ')), end)
+
+        syntax = _parse_syntax(text, start, end)
+
+        # At the top level we must have brackets and they must not be empty.
+        name, children = syntax
+        if not name and not children:
+            raise UserException(
+                    f"type hint '{text}': must have non-empty brackets")
+
+        _syntax_cache[text] = syntax
+
+    return syntax
+
+
+def _parse_syntax(text, start, end):
+    """ Return the syntax of part of a type hint.  The start and end are
+    assumed to exclude any leading and trailing spaces.
+    """
+
+    # Scan the parts without using recursion.  The name and number of parts of
+    # each part are saved so that the syntax can be built afterwards.
+    scanned = []
+    stack = [(start, end)]
+
+    while stack:
+        start, end = stack.pop()
+
+        # Find the name and any opening and closing brackets.
+        name_end = end
+        spans = None
+
+        i = text.find('[', start, end)
+        if i >= 0:
+            # The last character must be a closing bracket.
+            if text[end - 1] != ']':
+                raise UserException(
+                        f"type hint '{text}': ']' expected at position {end}")
+
+            # Find the end of any name.
+            name_end = _strip_trailing(text, start, i)
+
+            # Find the span of each part in a single pass, ie. up to each comma
+            # or closing bracket that isn't nested.  Only the delimiters are
+            # visited so that the characters of names are skipped by the
+            # regular expression engine rather than by Python code.
+            spans = []
+            depth = 0
+            part_start = i + 1
+
+            for delimiter in _DELIMITERS.finditer(text, part_start, end):
+                ch = delimiter.group()
+
+                if ch == '[':
+                    depth += 1
+
+                elif ch == ']' and depth != 0:
+                    depth -= 1
+
+                elif depth == 0:
+                    # Exclude any leading and trailing spaces.
+                    part_end = delimiter.start()
+
+                    while part_start < part_end and text[part_start] == ' ':
+                        part_start += 1
+
+                    part_end = _strip_trailing(text, part_start, part_end)
+
+                    spans.append((part_start, part_end))
+                    part_start = delimiter.end()
+
+            # Scan the parts in order next.
+            stack.extend(reversed(spans))
+
+        scanned.append(
+                (text[start:name_end], None if spans is None else len(spans)))
+
+    # Build the syntax of each part after that of its own parts, which are
+    # then the last ones to have been built (in reverse order).
+    built = []
+
+    for name, nr_children in reversed(scanned):
+        if nr_children is None:
+            children = None
+        elif nr_children == 0:
+            children = ()
+        else:
+            children = tuple(reversed(built[-nr_children:]))
+            del built[-nr_children:]
+
+        built.append((name, children))
+
+    return built[0]
+
+
+def _strip_trailing(text, start, end):
+    """ Return the index after the last non-space of a string. """
+
+    while end > start and text[end - 1] == ' ':
+        end -= 1
+
+    return end
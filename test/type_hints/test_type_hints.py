@@ -0,0 +1,46 @@
+# SPDX-License-Identifier: BSD-2-Clause
+
+# Copyright (c) 2024 Phil Thompson <phil@riverbankcomputing.com>
+
+
+import os
+import unittest
+
+from sipbuild.generator import parse, resolve
+from sipbuild.generator.outputs.type_hints import TypeHintManager
+from sipbuild.version import SIP_VERSION
+
+
+class TypeHintsTestCase(unittest.TestCase):
+    """ Test the parsing and rendering of type hints. """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Parse the specification used by the tests. """
+
+        sip_file = os.path.join(os.path.dirname(__file__), 'type_hints.sip')
+
+        spec, modules, _ = parse(sip_file, SIP_VERSION, 'UTF-8', '13.0', [],
+                [], False, [], 'sip')
+        resolve(spec, modules)
+
+        cls.spec = spec
+
+    def test_callable_identical_arguments(self):
+        """ Test the first argument of a Callable is rendered as an input when
+        the other argument is identical.
+        """
+
+        manager = TypeHintManager(self.spec)
+
+        self.assertEqual(
+                manager.as_docstring('Callable[WrappedIO, WrappedIO]', False,
+                        None),
+                'Callable[Union[WrappedIO, Klass], WrappedIO]')
+
+        defined = [klass.iface_file for klass in self.spec.classes]
+
+        self.assertEqual(
+                manager.as_type_hint('Callable[WrappedIO, WrappedIO]', False,
+                        None, defined),
+                'typing.Callable[typing.Union[WrappedIO, Klass], WrappedIO]')